@@ -1,16 +1,80 @@
 #!/usr/bin/env python3
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 
-import itertools
-from typing import List
-
+import bisect
+import functools
+import hashlib
+import logging
+import multiprocessing
+import os
+import pickle
+import sys
+from typing import List, Optional, Tuple
+
+import numpy as np
 import torch
 from pytext.data.bert_tensorizer import BERTTensorizer
 from pytext.data.roberta_tensorizer import RoBERTaTensorizer
 from pytext.data.tensorizers import lookup_tokens
-from pytext.data.utils import pad_and_tensorize
 from pytext.torchscript.tensorizer import ScriptRoBERTaTensorizerWithIndices
 from pytext.torchscript.vocab import ScriptVocabulary
+from pytext.utils import cuda
+from pytext.utils.file_io import PathManager
+
+
+# tensorizer used by a preprocessing worker, set once per process by
+# _init_numberize_worker so the tokenizer isn't shipped with every chunk
+_worker_tensorizer = None
+
+
+def _init_numberize_worker(tensorizer):
+    global _worker_tensorizer
+    _worker_tensorizer = tensorizer
+
+
+def _numberize_chunk(rows):
+    return _worker_tensorizer.numberize_batch(rows)
+
+
+def _remap_spans(start_idx, end_idx, answer_starts, answers, offset, pad_idx):
+    """Map raw answer spans to token indices, offset by `offset`. `start_idx` and
+    `end_idx` hold the raw offsets of the tokenized doc, with EoS as their last
+    entry. They are binary searched if they are non-decreasing, which is checked,
+    and looked up through dicts otherwise. Spans with no matching token boundary
+    map to `pad_idx`.
+    """
+    # the last entry of each belongs to EoS
+    doc_starts = list(start_idx[:-1])
+    doc_ends = list(end_idx[:-1])
+    if doc_starts != sorted(doc_starts) or doc_ends != sorted(doc_ends):
+        # out of order offsets (GPT-2 BPE gives -1 for tokens it can't find in
+        # the raw text) can't be binary searched, map them through dicts; later
+        # tokens overwrite earlier ones with the same offset
+        start_map = {raw: i + offset for i, raw in enumerate(doc_starts)}
+        end_map = {raw: i + offset for i, raw in enumerate(doc_ends)}
+        return (
+            [start_map.get(raw_start, pad_idx) for raw_start in answer_starts],
+            [
+                end_map.get(raw_start + len(answer), pad_idx)
+                for raw_start, answer in zip(answer_starts, answers)
+            ],
+        )
+
+    answer_start_indices = []
+    answer_end_indices = []
+    for raw_start, answer in zip(answer_starts, answers):
+        raw_end = raw_start + len(answer)
+        # binary search in C, taking the rightmost match if several tokens
+        # share a raw offset
+        start = bisect.bisect_right(doc_starts, raw_start) - 1
+        end = bisect.bisect_right(doc_ends, raw_end) - 1
+        answer_start_indices.append(
+            start + offset if start >= 0 and doc_starts[start] == raw_start else pad_idx
+        )
+        answer_end_indices.append(
+            end + offset if end >= 0 and doc_ends[end] == raw_end else pad_idx
+        )
+    return answer_start_indices, answer_end_indices
 
 
 class SquadForBERTTensorizer(BERTTensorizer):
@@ -18,6 +82,10 @@ class SquadForBERTTensorizer(BERTTensorizer):
 
     __EXPANSIBLE__ = True
     SPAN_PAD_IDX = -100
+    # seq len of a batch is padded up to a multiple of this so that fp16
+    # matmuls in the encoder can run on tensor cores
+    SEQ_LEN_MULTIPLE = 8
+    QUESTION_CACHE_SIZE = 65536
 
     class Config(BERTTensorizer.Config):
         columns: List[str] = ["question", "doc"]
@@ -52,6 +120,38 @@ class SquadForBERTTensorizer(BERTTensorizer):
         self.answers_column = answers_column
         self.answer_starts_column = answer_starts_column
         self.max_subseq_len = max_subseq_len
+        self._cache_special_indices()
+        self._build_question_cache()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        # lru_cache wrappers can't be pickled, rebuilt by __setstate__
+        state.pop("_lookup_question_tokens", None)
+        return state
+
+    def __setstate__(self, state):
+        # for backward compatibility with tensorizers pickled before the
+        # special token indices were cached
+        self.__dict__.update(state)
+        self._cache_special_indices()
+        self._build_question_cache()
+
+    def _build_question_cache(self):
+        # in Squad the same question is asked of several docs (or of several
+        # windows over one doc), so only tokenize each question once
+        self._lookup_question_tokens = functools.lru_cache(
+            maxsize=self.QUESTION_CACHE_SIZE
+        )(self._lookup_question_tokens_uncached)
+
+    def _lookup_question_tokens_uncached(self, text: str, seq_len: int):
+        question_tokens, _, _ = self._lookup_tokens(text, seq_len=seq_len)
+        return tuple(question_tokens)
+
+    def _cache_special_indices(self):
+        # numberize/tensorize run per row, so look these up once
+        self.bos_idx = self.vocab.get_bos_index()
+        self.eos_idx = self.vocab.get_eos_index()
+        self.pad_idx = self.vocab.get_pad_index()
 
     def _lookup_tokens(self, text: str, seq_len: int = None):
         # BoS token is added explicitly in numberize(), -1 from max_seq_len
@@ -67,99 +167,220 @@ class SquadForBERTTensorizer(BERTTensorizer):
 
     def _calculate_answer_indices(self, row, offset, start_idx, end_idx):
         # now map original answer spans to tokenized spans
-        start_idx_map = {}
-        end_idx_map = {}
-        for tokenized_idx, (raw_start_idx, raw_end_idx) in enumerate(
-            zip(start_idx[:-1], end_idx[:-1])
-        ):
-            start_idx_map[raw_start_idx] = tokenized_idx + offset
-            end_idx_map[raw_end_idx] = tokenized_idx + offset
-
-        answer_start_indices = [
-            start_idx_map.get(raw_idx, self.SPAN_PAD_IDX)
-            for raw_idx in row[self.answer_starts_column]
-        ]
-        answer_end_indices = [
-            end_idx_map.get(raw_idx + len(answer), self.SPAN_PAD_IDX)
-            for raw_idx, answer in zip(
-                row[self.answer_starts_column], row[self.answers_column]
-            )
-        ]
+        answer_start_indices, answer_end_indices = _remap_spans(
+            start_idx,
+            end_idx,
+            row[self.answer_starts_column],
+            row[self.answers_column],
+            offset,
+            self.SPAN_PAD_IDX,
+        )
         if not (answer_start_indices and answer_end_indices):
             answer_start_indices = [self.SPAN_PAD_IDX]
             answer_end_indices = [self.SPAN_PAD_IDX]
 
         return answer_start_indices, answer_end_indices
 
+    def _lookup_tokens_batch(self, texts: List[str], seq_len: int = None):
+        # tokenizers in PyText encode one string at a time, override this for
+        # tokenizers which can encode a whole column in a single call
+        return [self._lookup_tokens(text, seq_len=seq_len) for text in texts]
+
     def numberize(self, row):
         question_column, doc_column = self.columns
         doc_tokens, start_idx, end_idx = self._lookup_tokens(
             row[doc_column], seq_len=self.max_subseq_len
         )
-        question_tokens, _, _ = self._lookup_tokens(
-            row[question_column], seq_len=self.max_subseq_len
+        question_tokens = self._lookup_question_tokens(
+            row[question_column], self.max_subseq_len
+        )
+        return self._numberize_tokens(
+            row, question_tokens, doc_tokens, start_idx, end_idx
         )
-        question_tokens = [self.vocab.get_bos_index()] + question_tokens
-        seq_lens = (len(question_tokens), len(doc_tokens))
-        segment_labels = ([i] * seq_len for i, seq_len in enumerate(seq_lens))
-        tokens = list(itertools.chain(question_tokens, doc_tokens))
-        segment_labels = list(itertools.chain(*segment_labels))
-        offset = len(question_tokens)
-
-        # apply max_seq_len to each final seq
-        tokens = tokens[: self.max_seq_len]
-        segment_labels = segment_labels[: self.max_seq_len]
-        if tokens[-1] != self.vocab.get_eos_index():
+
+    def numberize_batch(self, rows):
+        question_column, doc_column = self.columns
+        max_subseq_len = self.max_subseq_len
+        docs = self._lookup_tokens_batch(
+            [row[doc_column] for row in rows], seq_len=max_subseq_len
+        )
+        # bound once, outside the per-row loop
+        lookup_question_tokens = self._lookup_question_tokens
+        numberize_tokens = self._numberize_tokens
+        return [
+            numberize_tokens(
+                row,
+                lookup_question_tokens(row[question_column], max_subseq_len),
+                doc_tokens,
+                start_idx,
+                end_idx,
+            )
+            for row, (doc_tokens, start_idx, end_idx) in zip(rows, docs)
+        ]
+
+    def preprocess_dataset(
+        self,
+        rows,
+        num_proc: Optional[int] = None,
+        chunk_size: int = 1000,
+        cache_path: Optional[str] = None,
+    ):
+        """Numberize `rows` in `num_proc` worker processes (default: one per CPU),
+        `chunk_size` rows at a time. If `cache_path` is given, the numberized rows
+        are saved there and later calls load them instead of tokenizing again.
+        The cache is keyed on the rows and on this tensorizer's vocab, tokenizer
+        and settings, a cache built from anything else is ignored and rebuilt."""
+        rows = list(rows)
+        if cache_path:
+            cache_key = self._preprocess_cache_key(rows)
+            if PathManager.isfile(cache_path):
+                with PathManager.open(cache_path, "rb") as f:
+                    cached = torch.load(f)
+                if isinstance(cached, dict) and cached.get("key") == cache_key:
+                    return cached["rows"]
+                logging.warning(
+                    f"Ignoring numberized rows cached in {cache_path}, they were "
+                    "built from different rows or tensorizer settings"
+                )
+
+        chunks = (rows[i : i + chunk_size] for i in range(0, len(rows), chunk_size))
+        # on Linux, forked workers share the tokenizer and vocab with this
+        # process copy-on-write rather than each unpickling their own copy;
+        # elsewhere (macOS, where forked children can crash) keep the default
+        start_method = "fork" if sys.platform.startswith("linux") else None
+        with multiprocessing.get_context(start_method).Pool(
+            num_proc or os.cpu_count(),
+            initializer=_init_numberize_worker,
+            initargs=(self,),
+        ) as pool:
+            numberized = [
+                numberized_row
+                for numberized_chunk in pool.imap(_numberize_chunk, chunks)
+                for numberized_row in numberized_chunk
+            ]
+
+        if cache_path:
+            with PathManager.open(cache_path, "wb") as f:
+                torch.save({"key": cache_key, "rows": numberized}, f)
+        return numberized
+
+    def _preprocess_cache_key(self, rows):
+        def settings(obj):
+            # plain-valued attributes: columns, max_seq_len, special indices...
+            return sorted(
+                (name, value)
+                for name, value in vars(obj).items()
+                if isinstance(value, (str, int, float, list, tuple))
+            )
+
+        key = hashlib.sha256()
+        for part in (
+            type(self).__qualname__,
+            settings(self),
+            type(self.tokenizer).__qualname__,
+            settings(self.tokenizer),
+            list(self.vocab),
+            rows,
+        ):
+            key.update(pickle.dumps(part))
+        return key.hexdigest()
+
+    def _numberize_tokens(self, row, question_tokens, doc_tokens, start_idx, end_idx):
+        # max_seq_len is read per call rather than baked in at __init__, it can
+        # be changed on a live tensorizer
+        max_seq_len = self.max_seq_len
+        eos_idx = self.eos_idx
+        tokens = [self.bos_idx, *question_tokens, *doc_tokens]
+        offset = len(question_tokens) + 1
+
+        # apply max_seq_len to the final seq
+        del tokens[max_seq_len:]
+        seq_len = len(tokens)
+        question_len = min(offset, seq_len)
+        segment_labels = [0] * question_len + [1] * (seq_len - question_len)
+        if tokens[-1] != eos_idx:
             # if the doc seq was truncated,
             # update final token to EoS
-            tokens[-1] = self.vocab.get_eos_index()
+            tokens[-1] = eos_idx
             # adjust the start_idx and end_idx seqs
-            spl_start_idx = start_idx[-1]
-            spl_end_idx = end_idx[-1]
-            start_idx = start_idx[: self.max_seq_len - offset - 1] + (spl_start_idx,)
-            end_idx = end_idx[: self.max_seq_len - offset - 1] + (spl_end_idx,)
-
-        seq_len = len(tokens)
-        positions = list(range(seq_len))
+            doc_len = max_seq_len - offset - 1
+            start_idx = start_idx[:doc_len] + (start_idx[-1],)
+            end_idx = end_idx[:doc_len] + (end_idx[-1],)
 
         # important to make sure labels are always aligned
         assert len(row[self.answers_column]) == len(
             row[self.answer_starts_column]
-        ), f"Answer Starts({row[self.answer_starts_column]}) and Answers({row[self.answer_column]}) columns misaligned."
+        ), f"Answer Starts({row[self.answer_starts_column]}) and Answers({row[self.answers_column]}) columns misaligned."
         answer_start_indices, answer_end_indices = self._calculate_answer_indices(
             row, offset, start_idx, end_idx
         )
+        # positions are just range(seq_len), tensorize() builds them per batch
         return (
             tokens,
             segment_labels,
             seq_len,
-            positions,
             answer_start_indices,
             answer_end_indices,
         )
 
-    def tensorize(self, batch):
-        (
-            tokens,
-            segment_labels,
-            seq_len,
-            positions,
-            answer_start_idx,
-            answer_end_idx,
-        ) = zip(*batch)
-        tokens = pad_and_tensorize(tokens, self.vocab.get_pad_index())
-        segment_labels = pad_and_tensorize(segment_labels, self.vocab.get_pad_index())
-        pad_mask = (tokens != self.vocab.get_pad_index()).long()
-        positions = pad_and_tensorize(positions)
-        answer_start_idx = pad_and_tensorize(answer_start_idx, self.SPAN_PAD_IDX)
-        answer_end_idx = pad_and_tensorize(answer_end_idx, self.SPAN_PAD_IDX)
+    def tensorize(self, batch, extra_float_columns: Tuple[int, ...] = ()):
+        # pad all fields in a single pass over the batch, writing each row
+        # straight into preallocated numpy buffers which torch then wraps
+        # without a copy. extra_float_columns index further per-token float
+        # fields of the numberized rows, these are padded along with the tokens
+        # and appended to the output in order
+        batch = list(batch)
+        pad_idx = self.pad_idx
+        longest = max(row[2] for row in batch)
+        # round up to SEQ_LEN_MULTIPLE, but not past the configured max_seq_len,
+        # positions past it would index outside the positional embeddings
+        max_seq_len = max(
+            longest,
+            min(longest + -longest % self.SEQ_LEN_MULTIPLE, self.max_seq_len),
+        )
+        seq_shape = (len(batch), max_seq_len)
+        answers_shape = (len(batch), max(len(row[3]) for row in batch))
+        tokens = np.full(seq_shape, pad_idx, dtype=np.int64)
+        # segment labels only feed an embedding lookup, which takes int32
+        # indices; answer indices stay int64 as loss targets
+        segment_labels = np.full(seq_shape, pad_idx, dtype=np.int32)
+        answer_start_idx = np.full(answers_shape, self.SPAN_PAD_IDX, dtype=np.int64)
+        answer_end_idx = np.full(answers_shape, self.SPAN_PAD_IDX, dtype=np.int64)
+        extra_floats = [
+            np.zeros(seq_shape, dtype=np.float32) for _ in extra_float_columns
+        ]
+        for i, row in enumerate(batch):
+            seq_len = row[2]
+            num_answers = len(row[3])
+            tokens[i, :seq_len] = row[0]
+            segment_labels[i, :seq_len] = row[1]
+            answer_start_idx[i, :num_answers] = row[3]
+            answer_end_idx[i, :num_answers] = row[4]
+            for column, extra in zip(extra_float_columns, extra_floats):
+                extra[i, : len(row[column])] = row[column]
+
+        device = cuda.device()
+        tokens = torch.from_numpy(tokens).to(device)
+        pad_mask = (tokens != pad_idx).long()
+        # the same positions for every row, as a broadcast view of one arange
+        positions = (
+            torch.arange(max_seq_len, dtype=torch.int32, device=device)
+            .unsqueeze(0)
+            .expand(len(batch), -1)
+        )
         return (
             tokens,
             pad_mask,
-            segment_labels,
+            torch.from_numpy(segment_labels).to(device),
             positions,
-            answer_start_idx,
-            answer_end_idx,
+            *(
+                torch.from_numpy(array).to(device)
+                for array in (
+                    answer_start_idx,
+                    answer_end_idx,
+                    *extra_floats,
+                )
+            ),
         )
 
 
@@ -198,18 +419,8 @@ class SquadForBERTTensorizerForKD(SquadForBERTTensorizer):
         self.pad_mask_column = pad_mask_column
         self.segment_labels_column = segment_labels_column
 
-        # For logging
-        self.total = 0
-        self.mismatches = 0
-
-    def __del__(self):
-        print("Destroying SquadForBERTTensorizerForKD object")
-        print(f"SquadForBERTTensorizerForKD: Number of rows read: {self.total}")
-        print(f"SquadForBERTTensorizerForKD: Number of rows dropped: {self.mismatches}")
-
-    def numberize(self, row):
-        self.total += 1
-        numberized_row_tuple = super().numberize(row)
+    def _numberize_tokens(self, row, *args):
+        numberized_row_tuple = super()._numberize_tokens(row, *args)
         try:
             tup = numberized_row_tuple + (
                 self._get_token_logits(
@@ -223,60 +434,37 @@ class SquadForBERTTensorizerForKD(SquadForBERTTensorizer):
         except KeyError:
             # Logits for KD Tensorizer not provided, using padding.
             tup = numberized_row_tuple + (
-                [self.vocab.get_pad_index()] * len(numberized_row_tuple[0]),
-                [self.vocab.get_pad_index()] * len(numberized_row_tuple[0]),
-                [self.vocab.get_pad_index()] * 2,
+                [self.pad_idx] * len(numberized_row_tuple[0]),
+                [self.pad_idx] * len(numberized_row_tuple[0]),
+                [self.pad_idx] * 2,
             )
 
         try:
-            assert len(tup[0]) == len(tup[6])
+            assert len(tup[0]) == len(tup[5])
         except AssertionError:
-            self.mismatches += 1
-            print(
-                f"len(tup[0]) = {len(tup[0])} and len(tup[6]) = {len(tup[6])}",
-                flush=True,
+            logging.warning(
+                f"len(tup[0]) = {len(tup[0])} and len(tup[5]) = {len(tup[5])}"
             )
             raise
         return tup
 
     def tensorize(self, batch):
-        (
-            tokens,
-            segment_labels,
-            seq_lens,
-            positions,
-            answer_start_idx,
-            answer_end_idx,
-            start_logits,
-            end_logits,
-            has_answer_logits,
-        ) = zip(*batch)
-
-        tensor_tuple = super().tensorize(
-            zip(
-                tokens,
-                segment_labels,
-                seq_lens,
-                positions,
-                answer_start_idx,
-                answer_end_idx,
-            )
-        )
-        return tensor_tuple + (
-            pad_and_tensorize(start_logits, dtype=torch.float),
-            pad_and_tensorize(end_logits, dtype=torch.float),
-            pad_and_tensorize(
-                has_answer_logits,
-                dtype=torch.float,
-                pad_shape=[len(has_answer_logits), len(has_answer_logits[0])],
-            ),
+        batch = list(batch)
+        # start/end logits (columns 5 and 6) are padded in the same pass as the
+        # tokens, to the same seq len; has_answer_logits always has 2 values
+        return super().tensorize(batch, extra_float_columns=(5, 6)) + (
+            cuda.tensor([row[7] for row in batch], dtype=torch.float),
         )
 
     def _get_token_logits(self, logits, pad_mask):
-        try:
-            pad_start = pad_mask.index(self.vocab.get_pad_index())
-        except ValueError:  # pad_index doesn't exits in pad_mask
-            pad_start = len(logits)
+        if isinstance(pad_mask, np.ndarray):
+            is_pad = pad_mask == self.pad_idx
+            pad_start = int(is_pad.argmax()) if is_pad.any() else len(logits)
+        else:
+            try:
+                pad_start = pad_mask.index(self.pad_idx)
+            except ValueError:  # pad_index doesn't exits in pad_mask
+                pad_start = len(logits)
         return logits[:pad_start]
 
 
@@ -376,20 +564,8 @@ class SquadForRoBERTaTensorizerForKD(SquadForRoBERTaTensorizer):
         self.pad_mask_column = pad_mask_column
         self.segment_labels_column = segment_labels_column
 
-        # For logging
-        self.total = 0
-        self.mismatches = 0
-
-    def __del__(self):
-        print("Destroying SquadForRoBERTaTensorizerForKD object")
-        print(f"SquadForRoBERTaTensorizerForKD: Number of rows read: {self.total}")
-        print(
-            f"SquadForRoBERTaTensorizerForKD: Number of rows dropped: {self.mismatches}"
-        )
-
-    def numberize(self, row):
-        self.total += 1
-        numberized_row_tuple = super().numberize(row)
+    def _numberize_tokens(self, row, *args):
+        numberized_row_tuple = super()._numberize_tokens(row, *args)
         try:
             tup = numberized_row_tuple + (
                 self._get_token_logits(
@@ -403,54 +579,30 @@ class SquadForRoBERTaTensorizerForKD(SquadForRoBERTaTensorizer):
         except KeyError:
             # Logits for KD Tensorizer not provided, using padding.
             tup = numberized_row_tuple + (
-                [self.vocab.get_pad_index()] * len(numberized_row_tuple[0]),
-                [self.vocab.get_pad_index()] * len(numberized_row_tuple[0]),
-                [self.vocab.get_pad_index()] * 2,
+                [self.pad_idx] * len(numberized_row_tuple[0]),
+                [self.pad_idx] * len(numberized_row_tuple[0]),
+                [self.pad_idx] * 2,
             )
         try:
-            assert len(tup[0]) == len(tup[6])
+            assert len(tup[0]) == len(tup[5])
         except AssertionError:
-            self.mismatches += 1
-            print(
-                f"len(tup[0]) = {len(tup[0])} and len(tup[6]) = {len(tup[6])}",
-                flush=True,
+            logging.warning(
+                f"len(tup[0]) = {len(tup[0])} and len(tup[5]) = {len(tup[5])}"
             )
             raise
         return tup
 
     def tensorize(self, batch):
-        (
-            tokens,
-            segment_labels,
-            seq_lens,
-            positions,
-            answer_start_idx,
-            answer_end_idx,
-            start_logits,
-            end_logits,
-            has_answer_logits,
-        ) = zip(*batch)
-
-        tensor_tuple = super().tensorize(
-            zip(
-                tokens,
-                segment_labels,
-                seq_lens,
-                positions,
-                answer_start_idx,
-                answer_end_idx,
-            )
-        )
-        return tensor_tuple + (
-            pad_and_tensorize(start_logits, dtype=torch.float),
-            pad_and_tensorize(end_logits, dtype=torch.float),
-            pad_and_tensorize(
-                has_answer_logits,
-                dtype=torch.float,
-                pad_shape=[len(has_answer_logits), len(has_answer_logits[0])],
-            ),
+        batch = list(batch)
+        # start/end logits (columns 5 and 6) are padded in the same pass as the
+        # tokens, to the same seq len; has_answer_logits always has 2 values
+        return super().tensorize(batch, extra_float_columns=(5, 6)) + (
+            cuda.tensor([row[7] for row in batch], dtype=torch.float),
         )
 
     def _get_token_logits(self, logits, pad_mask):
-        pad_start = pad_mask.count(self.vocab.get_pad_index())
+        if isinstance(pad_mask, np.ndarray):
+            pad_start = int(np.count_nonzero(pad_mask == self.pad_idx))
+        else:
+            pad_start = pad_mask.count(self.pad_idx)
         return logits[:pad_start]
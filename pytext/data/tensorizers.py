@@ -273,6 +273,11 @@ class Tensorizer(Component):
     def numberize(self, row):
         raise NotImplementedError
 
+    def numberize_batch(self, rows):
+        """Numberize a list of rows at once. The default numberizes row by row;
+        tensorizers whose tokenization benefits from batching can override this."""
+        return [self.numberize(row) for row in rows]
+
     def prepare_input(self, row):
         """Return preprocessed input tensors/blob for caffe2 prediction net."""
         return self.numberize(row)
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 
+import math
+import os
+import pickle
+import tempfile
 import unittest
 from typing import List
+from unittest import mock
 
 import numpy as np
 import pandas as pd
@@ -24,7 +29,10 @@ from pytext.data.sources.pandas import SessionPandasDataSource
 from pytext.data.sources.tsv import SessionTSVDataSource, TSVDataSource
 from pytext.data.squad_for_bert_tensorizer import (
     SquadForBERTTensorizer,
+    SquadForBERTTensorizerForKD,
     SquadForRoBERTaTensorizer,
+    SquadForRoBERTaTensorizerForKD,
+    _remap_spans,
 )
 from pytext.data.squad_tensorizer import SquadTensorizer
 from pytext.data.tensorizers import (
@@ -55,7 +63,7 @@ from pytext.data.tokenizers import (
     Tokenizer,
     WordPieceTokenizer,
 )
-from pytext.data.utils import Vocabulary
+from pytext.data.utils import Vocabulary, pad_and_tensorize
 from pytext.torchscript.utils import ScriptBatchInput
 from pytext.utils import precision
 from pytext.utils.test import import_tests_module
@@ -1362,7 +1370,7 @@ class SquadForRobertaTensorizerTest(unittest.TestCase):
                 max_seq_len=250,
             )
         )
-        tokens, segments, seq_len, positions, start, end = tensorizer.numberize(row)
+        tokens, segments, seq_len, start, end = tensorizer.numberize(row)
         # check against manually verified answer positions in tokenized output
         # there are 4 identical answers
         self.assertEqual(start, [3])
@@ -1387,7 +1395,7 @@ class SquadForBERTTensorizerTest(unittest.TestCase):
                 max_seq_len=250,
             )
         )
-        tokens, segments, seq_len, positions, start, end = tensorizer.numberize(row)
+        tokens, segments, seq_len, start, end = tensorizer.numberize(row)
         # check against manually verified answer positions in tokenized output
         # there are 4 identical answers
         self.assertEqual(start, [83, 83, 83, 83])
@@ -1397,12 +1405,376 @@ class SquadForBERTTensorizerTest(unittest.TestCase):
 
         tensorizer.max_seq_len = 50
         # answer should be truncated out
-        _, _, _, _, start, end = tensorizer.numberize(row)
+        _, _, _, start, end = tensorizer.numberize(row)
         self.assertEqual(start, [-100, -100, -100, -100])
         self.assertEqual(end, [-100, -100, -100, -100])
         self.assertEqual(len(tokens), seq_len)
         self.assertEqual(len(segments), seq_len)
 
+    def test_squad_tensorizer_misaligned_answers(self):
+        tensorizer = SquadForBERTTensorizer.from_config(
+            SquadForBERTTensorizer.Config(
+                tokenizer=WordPieceTokenizer.Config(
+                    wordpiece_vocab_path="pytext/data/test/data/wordpiece_1k.txt"
+                ),
+                max_seq_len=250,
+            )
+        )
+        row = {
+            "doc": "Prototype",
+            "question": "otype",
+            "answers": ["Prot", "Proto"],
+            "answer_starts": [0],
+        }
+        with self.assertRaisesRegex(AssertionError, "columns misaligned"):
+            tensorizer.numberize(row)
+
+    def test_squad_remap_spans_unsorted_offsets(self):
+        # GPT-2 BPE gives -1 offsets for tokens it can't find in the raw text,
+        # answers after such a token must still be found
+        start_idx = (0, 6, 12, -1, 25, -1)
+        end_idx = (5, 11, 17, -1, 30, -1)
+        starts, ends = _remap_spans(
+            start_idx, end_idx, [12, 25, 7], ["hello", "world", "xy"], 1, -100
+        )
+        self.assertEqual(starts, [3, 5, -100])
+        self.assertEqual(ends, [3, 5, -100])
+        # sorted offsets give the same result
+        starts, ends = _remap_spans(
+            (0, 6, 12, 18, 25, -1),
+            (5, 11, 17, 20, 30, -1),
+            [12, 25, 7],
+            ["hello", "world", "xy"],
+            1,
+            -100,
+        )
+        self.assertEqual(starts, [3, 5, -100])
+        self.assertEqual(ends, [3, 5, -100])
+
+    def test_squad_tensorizer_numberize_batch(self):
+        source = SquadDataSource.from_config(
+            SquadDataSource.Config(
+                eval_filename=tests_module.test_file("squad_tiny.json")
+            )
+        )
+        rows = list(source.eval)
+        tensorizer = SquadForBERTTensorizer.from_config(
+            SquadForBERTTensorizer.Config(
+                tokenizer=WordPieceTokenizer.Config(
+                    wordpiece_vocab_path="pytext/data/test/data/wordpiece_1k.txt"
+                ),
+                max_seq_len=250,
+            )
+        )
+        self.assertEqual(
+            tensorizer.numberize_batch(rows),
+            [tensorizer.numberize(row) for row in rows],
+        )
+        self.assertEqual(
+            tensorizer.preprocess_dataset(rows, num_proc=2, chunk_size=1),
+            [tensorizer.numberize(row) for row in rows],
+        )
+
+    def test_squad_tensorizer_question_cache(self):
+        source = SquadDataSource.from_config(
+            SquadDataSource.Config(
+                eval_filename=tests_module.test_file("squad_tiny.json")
+            )
+        )
+        rows = list(source.eval)
+        tensorizer = SquadForBERTTensorizer.from_config(
+            SquadForBERTTensorizer.Config(
+                tokenizer=WordPieceTokenizer.Config(
+                    wordpiece_vocab_path="pytext/data/test/data/wordpiece_1k.txt"
+                ),
+                max_seq_len=250,
+            )
+        )
+        expected = [tensorizer.numberize(row) for row in rows]
+        misses = tensorizer._lookup_question_tokens.cache_info().misses
+        # repeated questions are served from the cache
+        self.assertEqual(tensorizer.numberize_batch(rows), expected)
+        cache_info = tensorizer._lookup_question_tokens.cache_info()
+        self.assertEqual(cache_info.misses, misses)
+        self.assertGreaterEqual(cache_info.hits, len(rows))
+
+        # the cache isn't pickled, it's rebuilt empty on load
+        loaded = pickle.loads(pickle.dumps(tensorizer))
+        self.assertEqual(loaded._lookup_question_tokens.cache_info().currsize, 0)
+        self.assertEqual([loaded.numberize(row) for row in rows], expected)
+
+    def test_squad_tensorizer_preprocess_dataset_cache(self):
+        source = SquadDataSource.from_config(
+            SquadDataSource.Config(
+                eval_filename=tests_module.test_file("squad_tiny.json")
+            )
+        )
+        rows = list(source.eval)
+        tensorizer = SquadForBERTTensorizer.from_config(
+            SquadForBERTTensorizer.Config(
+                tokenizer=WordPieceTokenizer.Config(
+                    wordpiece_vocab_path="pytext/data/test/data/wordpiece_1k.txt"
+                ),
+                max_seq_len=250,
+            )
+        )
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_path = os.path.join(cache_dir, "numberized.pt")
+            expected = [tensorizer.numberize(row) for row in rows]
+            self.assertEqual(
+                tensorizer.preprocess_dataset(rows, num_proc=1, cache_path=cache_path),
+                expected,
+            )
+            # same rows and settings, the cached rows are loaded
+            with mock.patch.object(
+                tensorizer, "numberize_batch", side_effect=AssertionError
+            ):
+                self.assertEqual(
+                    tensorizer.preprocess_dataset(
+                        rows, num_proc=1, cache_path=cache_path
+                    ),
+                    expected,
+                )
+            # different rows or settings, the stale cache is rebuilt
+            with self.assertLogs(level="WARNING"):
+                self.assertEqual(
+                    tensorizer.preprocess_dataset(
+                        rows[:1], num_proc=1, cache_path=cache_path
+                    ),
+                    expected[:1],
+                )
+            tensorizer.max_seq_len = 50
+            with self.assertLogs(level="WARNING"):
+                self.assertEqual(
+                    tensorizer.preprocess_dataset(
+                        rows[:1], num_proc=1, cache_path=cache_path
+                    ),
+                    [tensorizer.numberize(rows[0])],
+                )
+
+    def test_squad_tensorize(self):
+        source = SquadDataSource.from_config(
+            SquadDataSource.Config(
+                eval_filename=tests_module.test_file("squad_tiny.json")
+            )
+        )
+        tensorizer = SquadForBERTTensorizer.from_config(
+            SquadForBERTTensorizer.Config(
+                tokenizer=WordPieceTokenizer.Config(
+                    wordpiece_vocab_path="pytext/data/test/data/wordpiece_1k.txt"
+                ),
+                max_seq_len=250,
+            )
+        )
+        batch = [tensorizer.numberize(row) for row in source.eval]
+        tokens, segments, _, starts, ends = zip(*batch)
+        pad_idx = tensorizer.vocab.get_pad_index()
+        # seq len is padded up to a multiple of 8, capped at max_seq_len
+        seq_shape = [
+            len(batch),
+            min(math.ceil(max(map(len, tokens)) / 8) * 8, tensorizer.max_seq_len),
+        ]
+        expected_tokens = pad_and_tensorize(tokens, pad_idx, seq_shape)
+        expected = (
+            expected_tokens,
+            (expected_tokens != pad_idx).long(),
+            pad_and_tensorize(segments, pad_idx, seq_shape),
+            torch.arange(seq_shape[1]).expand(*seq_shape),
+            pad_and_tensorize(starts, tensorizer.SPAN_PAD_IDX),
+            pad_and_tensorize(ends, tensorizer.SPAN_PAD_IDX),
+        )
+        tensors = tensorizer.tensorize(batch)
+        self.assertEqual(len(tensors), len(expected))
+        for tensor, expect in zip(tensors, expected):
+            self.assertEqual(tensor.tolist(), expect.tolist())
+        # segment labels and positions are narrowed to int32
+        self.assertEqual(tensors[2].dtype, torch.int32)
+        self.assertEqual(tensors[3].dtype, torch.int32)
+        self.assertEqual(tensors[4].dtype, torch.long)
+
+        # 50 isn't a multiple of 8, positions must stay inside max_seq_len
+        tensorizer.max_seq_len = 50
+        batch = [tensorizer.numberize(row) for row in source.eval]
+        self.assertEqual(max(row[2] for row in batch), 50)
+        tensors = tensorizer.tensorize(batch)
+        self.assertEqual(tensors[0].shape[1], 50)
+        self.assertEqual(tensors[3].max().item(), 49)
+
+
+class SquadForKDTensorizerTest(unittest.TestCase):
+    def _add_teacher_outputs(self, rows, batch, pad_mask_values):
+        # teacher outputs cover the teacher's padded seq, 3 longer than ours
+        valid, pad = pad_mask_values
+        kd_rows = []
+        for row, (tokens, *_) in zip(rows, batch):
+            seq_len = len(tokens)
+            kd_rows.append(
+                dict(
+                    row,
+                    start_logits=[0.5 * i for i in range(seq_len + 3)],
+                    end_logits=[-0.5 * i for i in range(seq_len + 3)],
+                    has_answer_logits=[0.25, 0.75],
+                    pad_mask=[valid] * seq_len + [pad] * 3,
+                )
+            )
+        return kd_rows
+
+    def _check_kd_tensorize(self, tensorizer, batch):
+        tensors = tensorizer.tensorize(batch)
+        self.assertEqual(len(tensors), 9)
+        tokens = tensors[0]
+        start_logits, end_logits, has_answer_logits = tensors[6:]
+        # start/end logits are padded along with the tokens, to the same width
+        for logits, column in ((start_logits, 5), (end_logits, 6)):
+            self.assertEqual(logits.dtype, torch.float)
+            self.assertEqual(logits.shape, tokens.shape)
+            self.assertEqual(
+                logits.tolist(),
+                pad_and_tensorize(
+                    [row[column] for row in batch],
+                    pad_shape=list(tokens.shape),
+                    dtype=torch.float,
+                ).tolist(),
+            )
+        self.assertEqual(has_answer_logits.dtype, torch.float)
+        self.assertEqual(list(has_answer_logits.shape), [len(batch), 2])
+        self.assertEqual(
+            has_answer_logits.tolist(), [list(map(float, row[7])) for row in batch]
+        )
+
+    def _check_kd_numberize_and_tensorize(self, tensorizer, rows, pad_mask_values):
+        pad_idx = tensorizer.vocab.get_pad_index()
+        # no teacher outputs in the rows, logits are filled with padding
+        batch = [tensorizer.numberize(row) for row in rows]
+        for tokens, *_, start_logits, end_logits, has_answer_logits in batch:
+            self.assertEqual(start_logits, [pad_idx] * len(tokens))
+            self.assertEqual(end_logits, [pad_idx] * len(tokens))
+            self.assertEqual(has_answer_logits, [pad_idx] * 2)
+        self._check_kd_tensorize(tensorizer, batch)
+
+        # teacher logits are cut down to the student's tokens
+        batch = [
+            tensorizer.numberize(row)
+            for row in self._add_teacher_outputs(rows, batch, pad_mask_values)
+        ]
+        for tokens, *_, start_logits, end_logits, has_answer_logits in batch:
+            self.assertEqual(start_logits, [0.5 * i for i in range(len(tokens))])
+            self.assertEqual(end_logits, [-0.5 * i for i in range(len(tokens))])
+            self.assertEqual(has_answer_logits, [0.25, 0.75])
+        self._check_kd_tensorize(tensorizer, batch)
+
+    def test_squad_bert_kd_tensorizer(self):
+        source = SquadDataSource.from_config(
+            SquadDataSource.Config(
+                eval_filename=tests_module.test_file("squad_tiny.json")
+            )
+        )
+        tensorizer = SquadForBERTTensorizerForKD.from_config(
+            SquadForBERTTensorizerForKD.Config(
+                tokenizer=WordPieceTokenizer.Config(
+                    wordpiece_vocab_path="pytext/data/test/data/wordpiece_1k.txt"
+                ),
+                max_seq_len=250,
+            )
+        )
+        # BERT teacher pad masks mark padding with the pad index
+        self._check_kd_numberize_and_tensorize(
+            tensorizer, list(source.eval), (1, tensorizer.vocab.get_pad_index())
+        )
+
+    def test_squad_roberta_kd_tensorizer(self):
+        rows = [
+            {
+                "id": 0,
+                "doc": "Prototype",
+                "question": "otype",
+                "answers": ["Prot"],
+                "answer_starts": [0],
+                "has_answer": True,
+            },
+            {
+                "id": 1,
+                "doc": "Prototype tensorizer",
+                "question": "what tensorizer",
+                "answers": ["tensorizer"],
+                "answer_starts": [10],
+                "has_answer": True,
+            },
+        ]
+        tensorizer = SquadForRoBERTaTensorizerForKD.from_config(
+            SquadForRoBERTaTensorizerForKD.Config(
+                tokenizer=GPT2BPETokenizer.Config(
+                    bpe_encoder_path="pytext/data/test/data/gpt2_encoder.json",
+                    bpe_vocab_path="pytext/data/test/data/gpt2_vocab.bpe",
+                ),
+                vocab_file="pytext/data/test/data/gpt2_dict.txt",
+                max_seq_len=250,
+            )
+        )
+        # the RoBERTa KD tensorizer takes the number of pad index entries in the
+        # teacher pad mask as the teacher's seq len
+        self._check_kd_numberize_and_tensorize(
+            tensorizer, rows, (tensorizer.vocab.get_pad_index(), 0)
+        )
+
+    def test_squad_kd_tensorizer_misaligned_logits(self):
+        source = SquadDataSource.from_config(
+            SquadDataSource.Config(
+                eval_filename=tests_module.test_file("squad_tiny.json")
+            )
+        )
+        tensorizer = SquadForBERTTensorizerForKD.from_config(
+            SquadForBERTTensorizerForKD.Config(
+                tokenizer=WordPieceTokenizer.Config(
+                    wordpiece_vocab_path="pytext/data/test/data/wordpiece_1k.txt"
+                ),
+                max_seq_len=250,
+            )
+        )
+        # teacher logits cover fewer tokens than the student's
+        row = dict(
+            next(iter(source.eval)),
+            start_logits=[0.0] * 3,
+            end_logits=[0.0] * 3,
+            has_answer_logits=[0.0, 0.0],
+            pad_mask=[1] * 3,
+        )
+        with self.assertLogs(level="WARNING") as logs:
+            with self.assertRaises(AssertionError):
+                tensorizer.numberize(row)
+        self.assertIn("len(tup[5]) = 3", logs.output[0])
+
+    def test_squad_kd_token_logits_pad_mask_types(self):
+        bert_tensorizer = SquadForBERTTensorizerForKD.from_config(
+            SquadForBERTTensorizerForKD.Config(
+                tokenizer=WordPieceTokenizer.Config(
+                    wordpiece_vocab_path="pytext/data/test/data/wordpiece_1k.txt"
+                ),
+                max_seq_len=250,
+            )
+        )
+        roberta_tensorizer = SquadForRoBERTaTensorizerForKD.from_config(
+            SquadForRoBERTaTensorizerForKD.Config(
+                tokenizer=GPT2BPETokenizer.Config(
+                    bpe_encoder_path="pytext/data/test/data/gpt2_encoder.json",
+                    bpe_vocab_path="pytext/data/test/data/gpt2_vocab.bpe",
+                ),
+                vocab_file="pytext/data/test/data/gpt2_dict.txt",
+                max_seq_len=250,
+            )
+        )
+        logits = [0.5 * i for i in range(8)]
+        for tensorizer in (bert_tensorizer, roberta_tensorizer):
+            pad_idx = tensorizer.vocab.get_pad_index()
+            for first, second in ((pad_idx, pad_idx + 1), (pad_idx + 1, pad_idx)):
+                for split in range(len(logits) + 1):
+                    pad_mask = [first] * split + [second] * (len(logits) - split)
+                    # numpy pad masks take the vectorised path, lists don't
+                    self.assertEqual(
+                        tensorizer._get_token_logits(logits, np.array(pad_mask)),
+                        tensorizer._get_token_logits(logits, pad_mask),
+                    )
+
 
 class SquadTensorizerTest(unittest.TestCase):
     def setUp(self):